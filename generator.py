@@ -1,25 +1,57 @@
+import heapq
 import json
 import random
 from datetime import datetime, timedelta
+from functools import reduce
+from operator import xor
 from faker import Faker
 from geopy.distance import distance as geodesic_dist
 from geopy.point import Point
-from pyais.encode import encode_dict
 
 fake = Faker()
 
 # Configuration
-DURATION_SECONDS = 60       
+DURATION_SECONDS = 60       # Event driven, hours of sim time are fine
+NUM_SHIPS = 3
+NUM_PLANES = 3
+NUM_CARS = 2
 START_TIME = datetime.utcnow()
 OUTPUT_FILE = "authentic_data.json"
 
 # --- HELPER: GPS Checksum Calculator ---
 def calculate_nmea_checksum(sentence):
     """Calculates standard NMEA XOR checksum for GPS/AIS"""
-    calc_cksum = 0
-    for s in sentence:
-        calc_cksum ^= ord(s)
-    return hex(calc_cksum)[2:].upper().zfill(2)
+    return f"{reduce(xor, sentence.encode(), 0):02X}"
+
+# --- HELPER: AIS Type 1 Encoder ---
+# 6-bit payload armoring: 0-39 -> '0'..'W', 40-63 -> '`'..'w'
+AIS_ARMOR = [chr(c + 48 if c < 40 else c + 56) for c in range(64)]
+
+def encode_ais_type1(mmsi, speed, lon, lat, course, heading, second):
+    """Bit-packs a 168-bit AIS position report (type 1) into an !AIVDM sentence.
+
+    Field scaling and truncation follow pyais, so the output is byte-for-byte
+    what encode_dict(..., talker_id="AI", sentence_type="VDM") produces for
+    status/turn/accuracy/maneuver/raim/radio all zero.
+    """
+    bits = 1                                                        # type (6), repeat (2)
+    bits = (bits << 32) | (int(mmsi) & 0x3FFFFFFF)                  # mmsi (30)
+    bits = (bits << 22) | (int(speed * 10.0) & 0x3FF)               # status (4), turn (8), speed (10)
+    bits = (bits << 29) | (round(lon * 600000.0) & 0xFFFFFFF)       # accuracy (1), lon (28)
+    bits = (bits << 27) | (round(lat * 600000.0) & 0x7FFFFFF)       # lat (27)
+    bits = (bits << 12) | (int(course * 10.0) & 0xFFF)              # course (12)
+    bits = (bits << 9) | (int(heading) & 0x1FF)                     # heading (9)
+    bits = (bits << 6) | (second & 0x3F)                            # second (6)
+    bits <<= 25                                                     # maneuver, spare, raim, radio
+    payload = "".join([AIS_ARMOR[(bits >> shift) & 63] for shift in range(162, -1, -6)])
+    body = f"AIVDM,1,1,,A,{payload},0"
+    return f"!{body}*{calculate_nmea_checksum(body)}"
+
+# Convert Dec degree to NMEA degree (ddmm.mmmm)
+def to_nmea_deg(deg):
+    d = int(deg)
+    m = (deg - d) * 60
+    return f"{d * 100 + m:09.4f}"
 
 # --- CLASSES FOR DIFFERENT DATA TYPES ---
 
@@ -58,19 +90,9 @@ class Ship(MovingEntity):
         self.interval = 2000 # AIS sends every ~2s
         
     def generate_packet(self, timestamp):
-        # 1. Use pyais to generate REAL !AIVDM string
-        nmea_payload = {
-            'type': 1, 'repeat': 0, 'mmsi': str(self.mmsi),
-            'status': 0, 'turn': 0, 'speed': round(self.speed, 1),
-            'accuracy': False, 'lon': self.lon, 'lat': self.lat,
-            'course': self.heading, 'heading': int(self.heading),
-            'second': timestamp.second, 'maneuver': 0,
-        }
-        try:
-            raw_list = encode_dict(nmea_payload, radio_channel="A", talker_id="AIVDM")
-            raw_msg = raw_list[0] if raw_list else ""
-        except:
-            raw_msg = "ERROR_ENCODING"
+        # 1. Generate REAL !AIVDM string (type 1 position report)
+        raw_msg = encode_ais_type1(self.mmsi, round(self.speed, 1), self.lon, self.lat,
+                                   self.heading, int(self.heading), timestamp.second)
 
         # 2. Return JSON matching VT Explorer style
         return {
@@ -127,12 +149,6 @@ class Car(MovingEntity):
         
         ts_str = timestamp.strftime("%H%M%S.%f")[:9] # hhmmss.ss
         date_str = timestamp.strftime("%d%m%y")
-        
-        # Convert Dec degree to NMEA degree (ddmm.mmmm)
-        def to_nmea_deg(deg):
-            d = int(deg)
-            m = (deg - d) * 60
-            return f"{d * 100 + m:09.4f}"
 
         lat_nmea = to_nmea_deg(abs(self.lat))
         lon_nmea = to_nmea_deg(abs(self.lon))
@@ -156,48 +172,58 @@ class Car(MovingEntity):
 
 # --- MAIN SIMULATION LOOP ---
 
+# Distinct random ids, so large fleets never merge two entities into one track
+def unique_ids(fmt, space, count):
+    return [fmt.format(n) for n in random.sample(range(space), count)]
+
+car_digits = max(2, len(str(NUM_CARS - 1)))
+
 entities = []
 # Create Fleet
-entities.extend([Ship(fake.numerify(text='2######00'), 70) for _ in range(3)]) # 3 Ships
-entities.extend([Plane(fake.hexify(text='^^^^^^')) for _ in range(3)])        # 3 Planes
-entities.extend([Car(fake.bothify(text='GPS-##')) for _ in range(2)])         # 2 Cars
+entities.extend([Ship(mmsi, 70) for mmsi in unique_ids("2{:06d}00", 10**6, NUM_SHIPS)])
+entities.extend([Plane(icao) for icao in unique_ids("{:06X}", 16**6, NUM_PLANES)])
+entities.extend([Car(vid) for vid in unique_ids(f"GPS-{{:0{car_digits}d}}", 10**car_digits, NUM_CARS)])
 
 print(f"Simulating {len(entities)} mixed entities...")
 
-data_log = []
-sim_cursor_ms = 0.0
 max_time_ms = DURATION_SECONDS * 1000.0
-step_size_ms = 10 # Physics fidelity
-
-while sim_cursor_ms < max_time_ms:
-    for entity in entities:
-        if sim_cursor_ms >= entity.next_ping:
-            
-            # Physics Move
-            jitter = random.uniform(-1, 1) # Tiny timing error
-            actual_time = entity.next_ping + jitter
-            event_dt = START_TIME + timedelta(milliseconds=actual_time)
-            
-            # Move entity forward by the time since its last ping
-            # (Approximation: we just move it by its interval duration)
-            entity.move(entity.interval / 1000.0)
-            
-            # Generate Data
-            packet = entity.generate_packet(event_dt)
-            data_log.append(packet)
-            
-            # Schedule next
-            # Add realistic jitter (e.g. +/- 10% of interval)
-            jitter_ms = random.uniform(-entity.interval * 0.1, entity.interval * 0.1)
-            entity.next_ping += (entity.interval + jitter_ms)
-
-    sim_cursor_ms += step_size_ms
-
-# Sort strictly by timestamp for the Sender
-data_log.sort(key=lambda x: x['TIMESTAMP'])
 
-with open(OUTPUT_FILE, 'w') as f:
-    json.dump(data_log, f, indent=2)
+# Event queue keyed by actual emission time, so packets pop out already in
+# timestamp order and only entities that are due get touched
+event_queue = []
+for idx, entity in enumerate(entities):
+    jitter = random.uniform(-1, 1) # Tiny timing error
+    heapq.heappush(event_queue, (entity.next_ping + jitter, idx))
+
+count = 0
+samples = {}
 
-print(f"Generated {len(data_log)} packets. Sample Raw Data:")
-print(f"AIS:  {data_log[0]['RAW_MSG'] if data_log else ''}")
\ No newline at end of file
+# Stream straight to disk, a JSON array of hours of packets won't fit in RAM
+with open(OUTPUT_FILE, 'w') as f:
+    f.write("[")
+    while event_queue:
+        actual_time, idx = heapq.heappop(event_queue)
+        entity = entities[idx]
+        if entity.next_ping >= max_time_ms: continue
+        event_dt = START_TIME + timedelta(milliseconds=actual_time)
+
+        # Move entity forward by the time since its last ping
+        # (Approximation: we just move it by its interval duration)
+        entity.move(entity.interval / 1000.0)
+
+        # Generate Data
+        packet = entity.generate_packet(event_dt)
+        f.write(",\n" if count else "\n")
+        f.write(json.dumps(packet))
+        samples.setdefault(packet["source_type"], packet["RAW_MSG"])
+        count += 1
+
+        # Schedule next
+        # Add realistic jitter (e.g. +/- 10% of interval)
+        jitter_ms = random.uniform(-entity.interval * 0.1, entity.interval * 0.1)
+        entity.next_ping += (entity.interval + jitter_ms)
+        heapq.heappush(event_queue, (entity.next_ping + random.uniform(-1, 1), idx))
+    f.write("\n]\n")
+
+print(f"Generated {count} packets. Sample Raw Data:")
+print(f"AIS:  {samples.get('AIS', '')}")
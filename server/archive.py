@@ -0,0 +1,272 @@
+import asyncio
+import heapq
+import json
+import os
+from itertools import islice
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Config
+ARCHIVE_DIR = "archive"
+RETENTION_SECONDS = 3600 # Keep the last hour hot in Mongo
+ARCHIVE_INTERVAL = 60 # Seconds between archiver passes
+ARCHIVE_CHUNK = 50000 # Records moved per write + delete_many
+READ_BATCH = 4096 # Rows decoded at a time per file when streaming
+
+# Known packet fields get typed columns. Anything else, or a known field whose
+# value isn't exactly the column's type (e.g. an int HEADING), rides along in
+# EXTRA as JSON so records come back exactly as they went in
+ARCHIVE_SCHEMA = pa.schema([
+    ("_id", pa.string()),
+    ("source_type", pa.string()),
+    ("MMSI", pa.string()),
+    ("ICAO", pa.string()),
+    ("VEHICLE_ID", pa.string()),
+    ("TIMESTAMP", pa.string()),
+    ("LATITUDE", pa.float64()),
+    ("LONGITUDE", pa.float64()),
+    ("SPEED", pa.float64()),
+    ("SPEED_KTS", pa.float64()),
+    ("SPEED_KPH", pa.float64()),
+    ("COURSE", pa.float64()),
+    ("HEADING", pa.float64()),
+    ("ALTITUDE_FT", pa.int64()),
+    ("NAME", pa.string()),
+    ("CALLSIGN", pa.string()),
+    ("RAW_MSG", pa.string()),
+    ("ts_sent", pa.string()),
+    ("ts_received", pa.string()),
+    ("ts_stored", pa.string()),
+    ("EXTRA", pa.string()),
+])
+PY_TYPES = {pa.string(): str, pa.float64(): float, pa.int64(): int}
+FIELD_TYPES = {f.name: PY_TYPES[f.type] for f in ARCHIVE_SCHEMA if f.name != "EXTRA"}
+# One hive partition per hour of ts_stored, e.g. archive/hour=2024-05-01T13/
+PARTITIONING = ds.partitioning(pa.schema([("hour", pa.string())]), flavor="hive")
+
+def to_row(doc):
+    row = {"_id": str(doc["_id"])}
+    extra = {}
+    for k, v in doc.items():
+        if k == "_id": continue
+        # Exact type match, so bools stay out of int64 and ints out of float64
+        if type(v) is FIELD_TYPES.get(k): row[k] = v
+        else: extra[k] = v
+    row["EXTRA"] = json.dumps(extra, default=str) if extra else None
+    return row
+
+def to_records(table):
+    # Inverse of to_row, drops the columns a packet type doesn't have.
+    # Takes a Table or a RecordBatch.
+    records = []
+    for row in table.to_pylist():
+        row.pop("hour", None)
+        extra = row.pop("EXTRA", None)
+        rec = {k: v for k, v in row.items() if v is not None}
+        if extra: rec.update(json.loads(extra))
+        records.append(rec)
+    return records
+
+def write_chunk(docs):
+    """Write docs (sorted by ts_stored) into their hourly partitions.
+
+    Files are named after the chunk's first _id so a pass that crashed before
+    its delete_many rewrites the same files instead of duplicating them.
+    """
+    by_hour = {}
+    for doc in docs:
+        by_hour.setdefault(doc["ts_stored"][:13], []).append(to_row(doc))
+    name = f"part-{docs[0]['_id']}.parquet"
+    for hour, rows in by_hour.items():
+        part_dir = os.path.join(ARCHIVE_DIR, f"hour={hour}")
+        os.makedirs(part_dir, exist_ok=True)
+        table = pa.Table.from_pylist(rows, schema=ARCHIVE_SCHEMA)
+        # Dot-prefixed temp files are skipped by dataset discovery
+        tmp_path = os.path.join(part_dir, f".{name}.tmp")
+        pq.write_table(table, tmp_path, compression="zstd", row_group_size=10000)
+        os.replace(tmp_path, os.path.join(part_dir, name))
+
+# --- REPLAY COORDINATION ---
+# archive_lock is held across each chunk's write + delete_many, so a replay
+# starting between chunks sees every record in exactly one store.
+# archived_through is the ts_stored of the newest archived record, and
+# replay_pins holds, per running replay, a ts_stored the archiver must not
+# reach (it only moves records strictly older than every pin).
+archive_lock = asyncio.Lock()
+archived_through = None
+replay_pins = {}
+
+async def begin_replay(start):
+    """Fix where a replay starting at `start` switches from archive to Mongo.
+
+    Returns (pin, split): records with ts_stored <= split come from the
+    archive, the rest from Mongo. split is None when nothing is archived.
+    Until end_replay(pin) the archiver leaves Mongo records >= the pin alone.
+    """
+    async with archive_lock:
+        split = archived_through
+        pin = object()
+        replay_pins[pin] = max(split, start) if split else start
+    return pin, split
+
+def advance_replay(pin, ts):
+    # Everything before ts has been read from Mongo, the archiver may take it
+    replay_pins[pin] = ts
+
+def end_replay(pin):
+    replay_pins.pop(pin, None)
+
+async def archive_once(collection):
+    global archived_through
+    cutoff = (datetime.utcnow() - timedelta(seconds=RETENTION_SECONDS)).isoformat(timespec="microseconds") + "Z"
+    moved = 0
+    while True:
+        async with archive_lock:
+            limit = min([cutoff, *replay_pins.values()])
+            cursor = collection.find({"ts_stored": {"$lt": limit}}).sort([("ts_stored", 1), ("_id", 1)]).limit(ARCHIVE_CHUNK)
+            docs = await cursor.to_list(length=ARCHIVE_CHUNK)
+            if not docs: break
+            # Parquet encoding is CPU bound, keep it off the event loop
+            await asyncio.to_thread(write_chunk, docs)
+            await collection.delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+            archived_through = docs[-1]["ts_stored"]
+        moved += len(docs)
+    return moved
+
+async def archiver(collection):
+    print("Archiver Started")
+    while True:
+        try:
+            moved = await archive_once(collection)
+            if moved: print(f"Archived {moved} records older than {RETENTION_SECONDS}s")
+        except Exception as e:
+            print(f"Archiver error: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+# --- READ PATH ---
+
+def open_archive():
+    if not os.path.isdir(ARCHIVE_DIR): return None
+    return ds.dataset(ARCHIVE_DIR, format="parquet", schema=ARCHIVE_SCHEMA.append(pa.field("hour", pa.string())),
+                      partitioning=PARTITIONING)
+
+def list_hours():
+    return sorted(e.name.split("=", 1)[1] for e in os.scandir(ARCHIVE_DIR) if e.name.startswith("hour="))
+
+def load_archived_through():
+    # Restore the archive high-water mark from the newest hour on disk
+    global archived_through
+    dataset = open_archive()
+    if dataset is None: return
+    hours = list_hours()
+    if not hours: return
+    table = dataset.to_table(columns=["ts_stored"], filter=ds.field("hour") == hours[-1])
+    if table.num_rows: archived_through = pc.max(table["ts_stored"]).as_py()
+
+def archived_ids_at(ts):
+    # _ids archived with exactly this ts_stored, to de-duplicate the split point
+    # The hour term prunes every other partition before any footer is read
+    table = scan_archive(columns=["_id"], filter=(ds.field("hour") == ts[:13]) & (ds.field("ts_stored") == ts))
+    return set(table["_id"].to_pylist())
+
+def time_filter(start=None, end=None):
+    # Hour partitions prune whole directories, ts_stored row-group stats prune the rest
+    expr = None
+    if start:
+        e = (ds.field("hour") >= start[:13]) & (ds.field("ts_stored") >= start)
+        expr = e if expr is None else expr & e
+    if end:
+        e = (ds.field("hour") <= end[:13]) & (ds.field("ts_stored") < end)
+        expr = e if expr is None else expr & e
+    return expr
+
+def scan_archive(start=None, end=None, columns=None, filter=None):
+    """Archived records with start <= ts_stored < end as a pyarrow Table.
+
+    `columns` limits which columns are read from disk, `filter` is an extra
+    pyarrow.dataset expression ANDed with the time range.
+    """
+    dataset = open_archive()
+    if dataset is None: return ARCHIVE_SCHEMA.empty_table().select(columns or ARCHIVE_SCHEMA.names)
+    expr = time_filter(start, end)
+    if filter is not None: expr = filter if expr is None else expr & filter
+    return dataset.to_table(columns=columns, filter=expr)
+
+def iter_fragment(fragment, expr):
+    for batch in fragment.to_batches(schema=ARCHIVE_SCHEMA, filter=expr, batch_size=READ_BATCH):
+        yield from to_records(batch)
+
+def record_key(rec):
+    return (rec["ts_stored"], rec["_id"])
+
+def iter_archive(start=None, end=None, chunk_size=ARCHIVE_CHUNK, through=None):
+    """Yield lists of archived records in ts_stored order.
+
+    start is inclusive, end exclusive, through an optional inclusive bound.
+
+    Every file is written already sorted, so each one is streamed in small
+    row batches and the files of an hour are merged, rather than loading and
+    sorting a whole partition before the first record comes out.
+    """
+    dataset = open_archive()
+    if dataset is None: return
+    hours = list_hours()
+    ts_expr = None
+    if start: ts_expr = ds.field("ts_stored") >= start
+    if end:
+        e = ds.field("ts_stored") < end
+        ts_expr = e if ts_expr is None else ts_expr & e
+    if through:
+        e = ds.field("ts_stored") <= through
+        ts_expr = e if ts_expr is None else ts_expr & e
+    for hour in hours:
+        if start and hour < start[:13]: continue
+        if end and hour > end[:13]: break
+        if through and hour > through[:13]: break
+        fragments = dataset.get_fragments(filter=ds.field("hour") == hour)
+        merged = heapq.merge(*[iter_fragment(f, ts_expr) for f in fragments], key=record_key)
+        while True:
+            chunk = list(islice(merged, chunk_size))
+            if not chunk: break
+            yield chunk
+
+def latest_archived(limit, through=None):
+    """The newest `limit` archived records with ts_stored <= through, oldest first.
+
+    Walks hours newest first and, within an hour, row groups by their
+    ts_stored max statistic (footers only), stopping as soon as no unread
+    row group can beat the records already collected.
+    """
+    if limit <= 0 or not os.path.isdir(ARCHIVE_DIR): return []
+    ts_idx = ARCHIVE_SCHEMA.get_field_index("ts_stored")
+    best = []
+    for hour in reversed(list_hours()):
+        if through and hour > through[:13]: continue
+        part_dir = os.path.join(ARCHIVE_DIR, f"hour={hour}")
+        groups = []
+        for entry in os.scandir(part_dir):
+            if entry.name.startswith(".") or not entry.name.endswith(".parquet"): continue
+            pf = pq.ParquetFile(entry.path)
+            for rg in range(pf.metadata.num_row_groups):
+                stats = pf.metadata.row_group(rg).column(ts_idx).statistics
+                # Without stats the group has to be read
+                top = stats.max if stats is not None and stats.has_min_max else "\uffff"
+                groups.append((top, entry.path, rg))
+        groups.sort(reverse=True)
+        for top, path, rg in groups:
+            if len(best) >= limit and top < best[-1]["ts_stored"]: break
+            table = pq.ParquetFile(path).read_row_group(rg)
+            if through: table = table.filter(pc.less_equal(table["ts_stored"], through))
+            best = heapq.nlargest(limit, best + to_records(table), key=record_key)
+        # Older hours only hold older records
+        if len(best) >= limit: break
+    best.reverse()
+    return best
+
+def count_archived():
+    dataset = open_archive()
+    return dataset.count_rows() if dataset is not None else 0
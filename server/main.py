@@ -1,12 +1,16 @@
 import asyncio
 import json
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import List
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from archive import (advance_replay, archived_ids_at, archiver, begin_replay, count_archived,
+                     end_replay, iter_archive, latest_archived, load_archived_through)
+from spatial import SpatialGrid, valid_position
+
 # Config
 UDP_IP = "127.0.0.1"
 UDP_PORT = 5005
@@ -14,14 +18,24 @@ MONGO_URL = "mongodb://localhost:27017"
 DB_NAME = "authenticDB"
 COLLECTION_NAME = "stream_data"
 BATCH_INTERVAL = 0.1 # 100ms batches
+REPLAY_PREFETCH = 20000 # records pulled per cursor chunk during replay
+REPLAY_QUEUE_CHUNKS = 4 # chunks buffered ahead of the playback clock
+GRID_CELL_DEG = 0.1 # ~11km spatial index cells
+MAX_RADIUS_KM = 2000 # Upper bound for proximity queries and geofences
+ENTITY_TTL = 300 # Seconds without a ping before an entity leaves the index
+ID_FIELDS = ("MMSI", "ICAO", "VEHICLE_ID")
 
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
 # Global Buffer
 packet_buffer = []
+geofence_events = []
 total_processed_count = 0
 
+# Latest position of every tracked entity
+spatial_index = SpatialGrid(cell_deg=GRID_CELL_DEG)
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
@@ -32,12 +46,19 @@ class ConnectionManager:
         # Send recent history (Last 1000)
         if collection is not None:
             cursor = collection.find().sort("ts_stored", -1).limit(1000)
-            history = await cursor.to_list(length=1000)
+            history = [fix_oid(d) for d in reversed(await cursor.to_list(length=1000))]
+            if len(history) < 1000:
+                # Hot collection is short (e.g. idle past retention), top up from the archive.
+                # Ties at the boundary can sit in both stores, so skip ids already sent.
+                through = history[0]["ts_stored"] if history else None
+                seen = {d["_id"] for d in history}
+                older = await asyncio.to_thread(latest_archived, 1000 - len(history), through)
+                history = [d for d in older if d["_id"] not in seen] + history
             if history:
                 # Send as batch
                 msg = {
                     "type": "batch", 
-                    "data": [fix_oid(d) for d in reversed(history)],
+                    "data": history,
                     "total_count": total_processed_count
                 }
                 await websocket.send_text(json.dumps(msg))
@@ -63,6 +84,22 @@ def fix_oid(doc):
     if "_id" in doc: doc["_id"] = str(doc["_id"])
     return doc
 
+def format_ts(dt):
+    # Always microsecond precision, so stored timestamps and bounds share one
+    # fixed-width format and compare correctly as strings
+    return dt.isoformat(timespec="microseconds") + "Z"
+
+def now_iso():
+    return format_ts(datetime.utcnow())
+
+def parse_ts(value):
+    # Stored timestamps are naive UTC isoformat strings with a trailing "Z",
+    # anything with an explicit offset is converted to that form
+    dt = datetime.fromisoformat(value.rstrip("Z"))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
 class UDPProtocol(asyncio.DatagramProtocol):
     def connection_made(self, transport):
         print(f"UDP Listener on {UDP_IP}:{UDP_PORT}")
@@ -75,24 +112,43 @@ async def handle_packet(data):
     try:
         msg = json.loads(data.decode())
         # 1. Received Time
-        msg["ts_received"] = datetime.utcnow().isoformat() + "Z"
+        msg["ts_received"] = now_iso()
         packet_buffer.append(msg)
         total_processed_count += 1
+        index_packet(msg)
     except:
         pass
 
+def index_packet(msg):
+    uid = next((msg[f] for f in ID_FIELDS if f in msg), None)
+    lat, lon = msg.get("LATITUDE"), msg.get("LONGITUDE")
+    if uid is None or not valid_position(lat, lon): return
+    events = spatial_index.update(uid, lat, lon, msg.get("source_type"))
+    if events:
+        for e in events: e["ts"] = msg["ts_received"]
+        geofence_events.extend(events)
+
 async def batch_processor():
     global packet_buffer
     print("Batch Processor Started")
     while True:
         await asyncio.sleep(BATCH_INTERVAL)
+        stale = spatial_index.evict_stale(ENTITY_TTL)
+        if stale:
+            now_str = now_iso()
+            for e in stale: e["ts"] = now_str
+            geofence_events.extend(stale)
+        if geofence_events:
+            events = geofence_events[:]
+            geofence_events.clear()
+            await manager.broadcast({"type": "geofence", "data": events})
         if not packet_buffer: continue
             
         current_batch = packet_buffer[:]
         packet_buffer.clear()
         
         # 2. Add Stored Timestamp (CRITICAL for calculating DB Latency)
-        now_str = datetime.utcnow().isoformat() + "Z"
+        now_str = now_iso()
         for p in current_batch:
             p["ts_stored"] = now_str
             if "_id" in p: del p["_id"]
@@ -111,11 +167,15 @@ async def startup():
     global db_client, collection, total_processed_count
     db_client = AsyncIOMotorClient(MONGO_URL)
     collection = db_client[DB_NAME][COLLECTION_NAME]
-    total_processed_count = await collection.count_documents({})
+    total_processed_count = await collection.count_documents({}) + await asyncio.to_thread(count_archived)
+    # History, replay and archiver all sort on (ts_stored, _id)
+    await collection.create_index([("ts_stored", 1), ("_id", 1)])
     
     loop = asyncio.get_running_loop()
     await loop.create_datagram_endpoint(lambda: UDPProtocol(), local_addr=(UDP_IP, UDP_PORT))
     asyncio.create_task(batch_processor())
+    await asyncio.to_thread(load_archived_through)
+    asyncio.create_task(archiver(collection))
 
 @app.on_event("shutdown")
 async def shutdown():
@@ -127,4 +187,151 @@ async def ws_endpoint(websocket: WebSocket):
     try:
         while True: await websocket.receive_text()
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
\ No newline at end of file
+        manager.disconnect(websocket)
+
+# --- SPATIAL QUERIES ---
+
+def check_position(lat, lon):
+    if not valid_position(lat, lon):
+        raise HTTPException(status_code=400, detail="lat must be in [-90, 90] and lon in [-180, 180]")
+
+@app.get("/entities/nearest")
+async def entities_nearest(lat: float, lon: float, n: int = 10):
+    check_position(lat, lon)
+    return spatial_index.nearest(lat, lon, n)
+
+@app.get("/entities/within")
+async def entities_within(lat: float, lon: float, radius_km: float):
+    check_position(lat, lon)
+    if not 0 < radius_km <= MAX_RADIUS_KM:
+        raise HTTPException(status_code=400, detail=f"radius_km must be in (0, {MAX_RADIUS_KM}]")
+    return spatial_index.within_radius(lat, lon, radius_km)
+
+@app.get("/geofences")
+async def list_geofences():
+    return [{"id": fid, "lat": lat, "lon": lon, "radius_km": r}
+            for fid, (lat, lon, r) in spatial_index.geofences.items()]
+
+@app.put("/geofences/{fence_id}")
+async def put_geofence(fence_id: str, lat: float, lon: float, radius_km: float):
+    check_position(lat, lon)
+    if not 0 < radius_km <= MAX_RADIUS_KM:
+        raise HTTPException(status_code=400, detail=f"radius_km must be in (0, {MAX_RADIUS_KM}]")
+    spatial_index.add_geofence(fence_id, lat, lon, radius_km)
+    return {"id": fence_id, "lat": lat, "lon": lon, "radius_km": radius_km}
+
+@app.delete("/geofences/{fence_id}")
+async def delete_geofence(fence_id: str):
+    if not spatial_index.remove_geofence(fence_id):
+        raise HTTPException(status_code=404, detail="Unknown geofence")
+    return {"id": fence_id}
+
+# --- REPLAY ---
+
+async def replay_prefetch(query, queue):
+    ts_range = query["ts_stored"]
+    start, end = ts_range["$gte"], ts_range.get("$lt")
+    # Split fixed up front, the pin keeps the archiver off what Mongo still owes us
+    pin, split = await begin_replay(start)
+    try:
+        mongo_range = ts_range
+        seen = set()
+        if split is not None and split >= start:
+            # Older parts of the window live in the Parquet archive, play those first
+            archived = iter_archive(start, end, REPLAY_PREFETCH, through=split)
+            while True:
+                chunk = await asyncio.to_thread(next, archived, None)
+                if chunk is None: break
+                await queue.put(chunk)
+            # Records sharing the split timestamp may exist in both stores
+            mongo_range = {**ts_range, "$gte": split}
+            seen = await asyncio.to_thread(archived_ids_at, split)
+
+        if end is None or mongo_range["$gte"] < end:
+            # Pull large cursor chunks ahead of playback so Mongo isn't hit per frame
+            cursor = collection.find({"ts_stored": mongo_range}).sort([("ts_stored", 1), ("_id", 1)]).batch_size(REPLAY_PREFETCH)
+            while True:
+                chunk = await cursor.to_list(length=REPLAY_PREFETCH)
+                if not chunk: break
+                advance_replay(pin, chunk[-1]["ts_stored"])
+                if seen: chunk = [d for d in chunk if str(d["_id"]) not in seen]
+                if chunk: await queue.put(chunk)
+        await queue.put(None)
+    except Exception as e:
+        # Hand the failure to the consumer instead of leaving it waiting forever
+        await queue.put(e)
+    finally:
+        end_replay(pin)
+
+async def replay_stream(websocket: WebSocket, query, speed):
+    queue = asyncio.Queue(maxsize=REPLAY_QUEUE_CHUNKS)
+    producer = asyncio.create_task(replay_prefetch(query, queue))
+    loop = asyncio.get_running_loop()
+
+    # Each live frame covers BATCH_INTERVAL of wallclock, so a replay frame
+    # covers BATCH_INTERVAL * speed of recorded time
+    frame_span = BATCH_INTERVAL * speed
+    t0_recorded = None
+    t0_wallclock = None
+    frame_idx = 0
+    frame = []
+    sent = 0
+
+    async def flush():
+        nonlocal frame, sent
+        # Live batches go out at the end of their window, mirror that here
+        sleep_dur = t0_wallclock + (frame_idx + 1) * BATCH_INTERVAL - loop.time()
+        if sleep_dur > 0:
+            await asyncio.sleep(sleep_dur)
+        sent += len(frame)
+        await websocket.send_text(json.dumps({
+            "type": "batch",
+            "data": [fix_oid(d) for d in frame],
+            "total_count": sent
+        }))
+        frame = []
+
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None: break
+            if isinstance(chunk, Exception): raise chunk
+            for doc in chunk:
+                ts = parse_ts(doc["ts_stored"])
+                if t0_recorded is None:
+                    t0_recorded = ts
+                    t0_wallclock = loop.time()
+                idx = int((ts - t0_recorded).total_seconds() // frame_span)
+                if idx > frame_idx:
+                    if frame: await flush()
+                    frame_idx = idx
+                frame.append(doc)
+        if frame: await flush()
+        await websocket.send_text(json.dumps({"type": "replay_end", "total_count": sent}))
+    finally:
+        producer.cancel()
+
+@app.websocket("/ws/replay")
+async def ws_replay(websocket: WebSocket, start: str, end: str = None, speed: float = 1.0):
+    await websocket.accept()
+    try:
+        ts_range = {"$gte": format_ts(parse_ts(start))}
+        if end: ts_range["$lt"] = format_ts(parse_ts(end))
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    if speed <= 0 or collection is None:
+        await websocket.close(code=1008)
+        return
+
+    try:
+        await replay_stream(websocket, {"ts_stored": ts_range}, speed)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"Replay error: {e}")
+        try:
+            await websocket.close(code=1011)
+        except:
+            pass # Socket already gone
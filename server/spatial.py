@@ -0,0 +1,231 @@
+import math
+import time
+from collections import OrderedDict
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEG_LAT = 111.195
+MAX_FENCE_CELLS = 10000 # Bigger fences are checked on every update instead
+
+def valid_position(lat, lon):
+    # Real, finite, in-range degrees only (bools and strings are rejected)
+    return (type(lat) in (int, float) and type(lon) in (int, float)
+            and math.isfinite(lat) and math.isfinite(lon)
+            and -90 <= lat <= 90 and -180 <= lon <= 180)
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dlat = p2 - p1
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+class SpatialGrid:
+    """Uniform lat/lon grid holding the latest position of every tracked entity.
+
+    Entities live in one cell keyed by (lat_idx, lon_idx), where lon_idx wraps
+    around the antimeridian modulo lon_cells. Geofences are
+    registered in every cell their circle overlaps, so an update only has to
+    look at the fences in the entity's new cell plus the ones it was inside.
+    """
+
+    def __init__(self, cell_deg=0.1):
+        self.cell_deg = cell_deg
+        self.lon_cells = round(360 / cell_deg) # Columns around the globe
+        self.cells = {}         # cell -> set of entity ids
+        self.positions = {}     # entity id -> (lat, lon, source_type, cell)
+        self.geofences = {}     # fence id -> (lat, lon, radius_km)
+        self.fence_cells = {}   # cell -> set of fence ids
+        self.wide_fences = set() # fence ids covering more than MAX_FENCE_CELLS
+        self.inside = {}        # entity id -> set of fence ids it is inside
+        self.last_seen = OrderedDict() # entity id -> monotonic time, oldest first
+
+    def _row(self, lat):
+        return math.floor(lat / self.cell_deg)
+
+    def _col(self, lon):
+        # Unwrapped column, callers take it modulo lon_cells
+        return math.floor((lon + 180.0) / self.cell_deg)
+
+    def _cell(self, lat, lon):
+        return (self._row(lat), self._col(lon) % self.lon_cells)
+
+    def _covering_range(self, lat, lon, radius_km):
+        # Bounding box of the circle in cell units, as (lo_i, hi_i, lo_j, hi_j).
+        # Columns are unwrapped (lo_j may be negative or hi_j past lon_cells),
+        # take them modulo lon_cells. Clamped to the poles; a box reaching a
+        # pole or spanning 360 degrees covers every column.
+        dlat = radius_km / KM_PER_DEG_LAT
+        lat_lo, lat_hi = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+        if lat_lo <= -90.0 or lat_hi >= 90.0:
+            dlon = 180.0
+        else:
+            coslat = math.cos(math.radians(max(abs(lat_lo), abs(lat_hi))))
+            dlon = min(180.0, radius_km / (KM_PER_DEG_LAT * coslat))
+        lo_j, hi_j = self._col(lon - dlon), self._col(lon + dlon)
+        if dlon >= 180.0 or hi_j - lo_j + 1 >= self.lon_cells:
+            lo_j, hi_j = 0, self.lon_cells - 1
+        return self._row(lat_lo), self._row(lat_hi), lo_j, hi_j
+
+    def _range_cells(self, lo_i, hi_i, lo_j, hi_j):
+        return [(i, j % self.lon_cells) for i in range(lo_i, hi_i + 1) for j in range(lo_j, hi_j + 1)]
+
+    def _cells_covering(self, lat, lon, radius_km):
+        lo_i, hi_i, lo_j, hi_j = self._covering_range(lat, lon, radius_km)
+        span_j = hi_j - lo_j
+        if (hi_i - lo_i + 1) * (span_j + 1) > len(self.cells):
+            # Box holds more cells than are occupied, walk the occupied ones
+            return [c for c in self.cells
+                    if lo_i <= c[0] <= hi_i and (c[1] - lo_j) % self.lon_cells <= span_j]
+        return self._range_cells(lo_i, hi_i, lo_j, hi_j)
+
+    # --- Entities ---
+
+    def update(self, uid, lat, lon, source_type=None, now=None):
+        """Move an entity and return any geofence enter/exit events."""
+        if not valid_position(lat, lon):
+            raise ValueError(f"Invalid position ({lat!r}, {lon!r})")
+        self.last_seen[uid] = time.monotonic() if now is None else now
+        self.last_seen.move_to_end(uid)
+        cell = self._cell(lat, lon)
+        prev = self.positions.get(uid)
+        if prev is None or prev[3] != cell:
+            if prev is not None:
+                old = self.cells[prev[3]]
+                old.discard(uid)
+                if not old: del self.cells[prev[3]]
+            self.cells.setdefault(cell, set()).add(uid)
+        self.positions[uid] = (lat, lon, source_type, cell)
+
+        if not self.geofences: return []
+        was_inside = self.inside.get(uid, set())
+        now_inside = set()
+        for fid in self.wide_fences.union(self.fence_cells.get(cell, ())):
+            f_lat, f_lon, radius_km = self.geofences[fid]
+            if haversine_km(lat, lon, f_lat, f_lon) <= radius_km:
+                now_inside.add(fid)
+        if now_inside == was_inside: return []
+
+        if now_inside: self.inside[uid] = now_inside
+        else: self.inside.pop(uid, None)
+        events = []
+        for fid in now_inside - was_inside:
+            events.append(self._event(fid, "enter", uid, lat, lon, source_type))
+        for fid in was_inside - now_inside:
+            events.append(self._event(fid, "exit", uid, lat, lon, source_type))
+        return events
+
+    def remove(self, uid):
+        """Drop an entity, returning exit events for the fences it was inside."""
+        # Always forget last_seen, evict_stale relies on this to make progress
+        self.last_seen.pop(uid, None)
+        prev = self.positions.pop(uid, None)
+        if prev is None: return []
+        old = self.cells[prev[3]]
+        old.discard(uid)
+        if not old: del self.cells[prev[3]]
+        lat, lon, source_type, _ = prev
+        return [self._event(fid, "exit", uid, lat, lon, source_type)
+                for fid in self.inside.pop(uid, ())]
+
+    def evict_stale(self, max_age, now=None):
+        """Remove entities not updated for max_age seconds, returning exit events."""
+        cutoff = (time.monotonic() if now is None else now) - max_age
+        events = []
+        while self.last_seen:
+            uid, seen = next(iter(self.last_seen.items()))
+            if seen > cutoff: break
+            events.extend(self.remove(uid))
+        return events
+
+    def _event(self, fid, kind, uid, lat, lon, source_type):
+        return {"fence_id": fid, "event": kind, "id": uid, "source_type": source_type,
+                "lat": lat, "lon": lon}
+
+    def _entry(self, uid, dist):
+        lat, lon, source_type, _ = self.positions[uid]
+        return {"id": uid, "source_type": source_type, "lat": lat, "lon": lon,
+                "distance_km": round(dist, 4)}
+
+    # --- Queries ---
+
+    def within_radius(self, lat, lon, radius_km):
+        """Entities within radius_km of (lat, lon), closest first."""
+        hits = []
+        for cell in self._cells_covering(lat, lon, radius_km):
+            for uid in self.cells.get(cell, ()):
+                e_lat, e_lon = self.positions[uid][:2]
+                d = haversine_km(lat, lon, e_lat, e_lon)
+                if d <= radius_km: hits.append((d, uid))
+        hits.sort()
+        return [self._entry(uid, d) for d, uid in hits]
+
+    def nearest(self, lat, lon, n=10):
+        """The n entities closest to (lat, lon), closest first."""
+        if n <= 0 or not self.positions: return []
+        ci, cj = self._cell(lat, lon)
+
+        found = []
+        visited = set() # Wide rings wrap onto columns already searched
+        ring = 0
+        while True:
+            if len(visited) + 8 * ring > len(self.cells):
+                # Searched more cells than are occupied, finish by brute force
+                found = [(haversine_km(lat, lon, *self.positions[uid][:2]), uid)
+                         for uid in self.positions]
+                break
+            if ring == 0:
+                ring_cells = [(ci, cj)]
+            else:
+                ring_cells = [(ci + di, (cj + dj) % self.lon_cells)
+                              for di in range(-ring, ring + 1)
+                              for dj in (-ring, ring)]
+                ring_cells += [(ci + di, (cj + dj) % self.lon_cells)
+                               for di in (-ring, ring)
+                               for dj in range(-ring + 1, ring)]
+            for cell in ring_cells:
+                if cell in visited: continue
+                visited.add(cell)
+                for uid in self.cells.get(cell, ()):
+                    found.append((haversine_km(lat, lon, *self.positions[uid][:2]), uid))
+            if len(found) >= n:
+                # Narrowest cell width (km) within the searched rings bounds
+                # how far a fully searched ring is guaranteed to reach
+                coslat = max(math.cos(math.radians(min(89.9, abs(lat) + (ring + 1) * self.cell_deg))), 1e-6)
+                cell_km = self.cell_deg * KM_PER_DEG_LAT * min(1.0, coslat)
+                found.sort()
+                if found[n - 1][0] <= ring * cell_km: break
+            ring += 1
+
+        found.sort()
+        return [self._entry(uid, d) for d, uid in found[:n]]
+
+    # --- Geofences ---
+
+    def add_geofence(self, fid, lat, lon, radius_km):
+        if fid in self.geofences: self.remove_geofence(fid)
+        self.geofences[fid] = (lat, lon, radius_km)
+        lo_i, hi_i, lo_j, hi_j = self._covering_range(lat, lon, radius_km)
+        if (hi_i - lo_i + 1) * (hi_j - lo_j + 1) > MAX_FENCE_CELLS:
+            self.wide_fences.add(fid)
+        else:
+            for cell in self._range_cells(lo_i, hi_i, lo_j, hi_j):
+                self.fence_cells.setdefault(cell, set()).add(fid)
+        # Seed membership so entities already inside don't fire a spurious enter
+        for hit in self.within_radius(lat, lon, radius_km):
+            self.inside.setdefault(hit["id"], set()).add(fid)
+
+    def remove_geofence(self, fid):
+        fence = self.geofences.pop(fid, None)
+        if fence is None: return False
+        if fid in self.wide_fences:
+            self.wide_fences.discard(fid)
+        else:
+            for cell in self._range_cells(*self._covering_range(*fence)):
+                fids = self.fence_cells.get(cell)
+                if fids is None: continue
+                fids.discard(fid)
+                if not fids: del self.fence_cells[cell]
+        for uid in list(self.inside):
+            self.inside[uid].discard(fid)
+            if not self.inside[uid]: del self.inside[uid]
+        return True